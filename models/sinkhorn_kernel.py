@@ -0,0 +1,116 @@
+""" Fused Triton kernels for the log-space Sinkhorn iterations of SuperGlue
+
+Each half-iteration `u = log_mu - logsumexp(Z + v, dim=2)` (and the column
+counterpart for v) is a single kernel that streams Z once, tile by tile, with
+an online logsumexp. The PyTorch version materializes Z + v and makes four
+more passes over it for the max, subtraction, exp-sum and log.
+
+This module needs the optional `triton` package, torch>=2.4 and a CUDA
+device, and is only imported when the SuperGlue config asks for
+'sinkhorn_kernel': 'triton'. The operator is registered as
+torch.ops.superglue.log_sinkhorn_iterations and has no backward, i.e. it is
+meant for inference.
+"""
+
+import torch
+import triton
+import triton.language as tl
+
+from .superglue_triton import log_sinkhorn_iterations as torch_log_sinkhorn
+
+BLOCK_M = 64
+BLOCK_N = 64
+
+
+@triton.jit
+def row_update_kernel(Z, v, log_mu, u, M, N,
+                      BLOCK_M: tl.constexpr, BLOCK_N: tl.constexpr):
+  """ u[b, i] = log_mu[b, i] - logsumexp_j(Z[b, i, j] + v[b, j]) """
+  b = tl.program_id(0)
+  rows = tl.program_id(1) * BLOCK_M + tl.arange(0, BLOCK_M)
+  row_mask = rows < M
+  Z += b * M * N
+  m_i = tl.full([BLOCK_M], float('-inf'), tl.float32)
+  s_i = tl.zeros([BLOCK_M], tl.float32)
+  for start in range(0, N, BLOCK_N):
+    cols = start + tl.arange(0, BLOCK_N)
+    col_mask = cols < N
+    x = tl.load(Z + rows[:, None] * N + cols[None, :],
+                mask=row_mask[:, None] & col_mask[None, :],
+                other=float('-inf'))
+    x += tl.load(v + b * N + cols, mask=col_mask, other=0.)[None, :]
+    m_new = tl.maximum(m_i, tl.max(x, 1))
+    s_i = s_i * tl.exp(m_i - m_new) + tl.sum(tl.exp(x - m_new[:, None]), 1)
+    m_i = m_new
+  mu = tl.load(log_mu + b * M + rows, mask=row_mask)
+  tl.store(u + b * M + rows, mu - m_i - tl.log(s_i), mask=row_mask)
+
+
+@triton.jit
+def col_update_kernel(Z, u, log_nu, v, M, N,
+                      BLOCK_M: tl.constexpr, BLOCK_N: tl.constexpr):
+  """ v[b, j] = log_nu[b, j] - logsumexp_i(Z[b, i, j] + u[b, i]) """
+  b = tl.program_id(0)
+  cols = tl.program_id(1) * BLOCK_N + tl.arange(0, BLOCK_N)
+  col_mask = cols < N
+  Z += b * M * N
+  m_j = tl.full([BLOCK_N], float('-inf'), tl.float32)
+  s_j = tl.zeros([BLOCK_N], tl.float32)
+  for start in range(0, M, BLOCK_M):
+    rows = start + tl.arange(0, BLOCK_M)
+    row_mask = rows < M
+    x = tl.load(Z + rows[:, None] * N + cols[None, :],
+                mask=row_mask[:, None] & col_mask[None, :],
+                other=float('-inf'))
+    x += tl.load(u + b * M + rows, mask=row_mask, other=0.)[:, None]
+    m_new = tl.maximum(m_j, tl.max(x, 0))
+    s_j = s_j * tl.exp(m_j - m_new) + tl.sum(tl.exp(x - m_new[None, :]), 0)
+    m_j = m_new
+  nu = tl.load(log_nu + b * N + cols, mask=col_mask)
+  tl.store(v + b * N + cols, nu - m_j - tl.log(s_j), mask=col_mask)
+
+
+def triton_log_sinkhorn_iterations(Z, log_mu, log_nu, iters: int):
+  """ Same result as log_sinkhorn_iterations (without early stopping) """
+  Z = Z.float().contiguous()
+  log_mu, log_nu = log_mu.float().contiguous(), log_nu.float().contiguous()
+  b, m, n = Z.shape
+  u, v = torch.zeros_like(log_mu), torch.zeros_like(log_nu)
+  row_grid = (b, triton.cdiv(m, BLOCK_M))
+  col_grid = (b, triton.cdiv(n, BLOCK_N))
+  for _ in range(iters):
+    row_update_kernel[row_grid](
+        Z, v, log_mu, u, m, n, BLOCK_M=BLOCK_M, BLOCK_N=BLOCK_N)
+    col_update_kernel[col_grid](
+        Z, u, log_nu, v, m, n, BLOCK_M=BLOCK_M, BLOCK_N=BLOCK_N)
+  return Z + u[:, :, None] + v[:, None, :]
+
+
+@torch.library.custom_op('superglue::log_sinkhorn_iterations',
+                         mutates_args=(), device_types='cuda')
+def log_sinkhorn_iterations(Z: torch.Tensor, log_mu: torch.Tensor,
+                            log_nu: torch.Tensor, iters: int) -> torch.Tensor:
+  return triton_log_sinkhorn_iterations(Z, log_mu, log_nu, iters)
+
+
+@log_sinkhorn_iterations.register_kernel('cpu')
+def _(Z, log_mu, log_nu, iters):
+  return torch_log_sinkhorn(Z.float(), log_mu.float(), log_nu.float(), iters)
+
+
+@log_sinkhorn_iterations.register_fake
+def _(Z, log_mu, log_nu, iters):
+  return torch.empty_like(Z, dtype=torch.float)
+
+
+class TritonLogSinkhorn(torch.jit.ScriptModule):
+  """ Drop-in replacement of LogSinkhorn running the fused kernels """
+
+  def __init__(self, iters: int):
+    super().__init__()
+    self.iters = iters
+
+  @torch.jit.script_method
+  def forward(self, Z, log_mu, log_nu):
+    return torch.ops.superglue.log_sinkhorn_iterations(
+        Z, log_mu, log_nu, self.iters)
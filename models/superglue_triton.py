@@ -40,21 +40,22 @@
 # --------------------------------------------------------------------*/
 # %BANNER_END%
 
+import math
+from collections import OrderedDict
 from copy import deepcopy
 from pathlib import Path
-from typing import List, Dict
+from typing import Dict
 
 import torch
 from torch import nn
 
 
 def MLP(channels: list, do_bn=True):
-  """ Multi-layer perceptron """
+  """ Multi-layer perceptron applied to (num_points, channels) rows """
   n = len(channels)
   layers = []
   for i in range(1, n):
-    layers.append(
-        nn.Conv1d(channels[i - 1], channels[i], kernel_size=1, bias=True))
+    layers.append(nn.Linear(channels[i - 1], channels[i], bias=True))
     if i < (n-1):
       if do_bn:
         layers.append(nn.BatchNorm1d(channels[i]))
@@ -62,14 +63,22 @@ def MLP(channels: list, do_bn=True):
   return nn.Sequential(*layers)
 
 
-def normalize_keypoints(kpts, size: torch.Tensor):
-  """ Normalize keypoints locations based on image image_shape"""
-  # height, width = shape
-  # size = torch.tensor([[width, height]], dtype=torch.float, device=kpts.device)
-  size = size.to(kpts.device)
+@torch.jit.script
+def keypoint_transform(size):
+  """ Center (b, 1, 2) and scaling (b, 1, 1) for image size (b, [W, H])
+
+  For a constant image size, compute these once on the keypoints' device and
+  pass them to SuperGlue.match instead of calling forward with the size.
+  """
   center = size / 2
   scaling = size.max(1, keepdim=True).values * 0.7
-  return (kpts - center[:, None, :]) / scaling[:, None, :]
+  return center[:, None, :], scaling[:, None, :]
+
+
+def normalize_keypoints(kpts, size: torch.Tensor):
+  """ Normalize keypoints locations based on image size (1, [W, H])"""
+  center, scaling = keypoint_transform(size.to(kpts.device))
+  return (kpts - center) / scaling
 
 
 class KeypointEncoder(torch.jit.ScriptModule):
@@ -82,38 +91,52 @@ class KeypointEncoder(torch.jit.ScriptModule):
 
   @torch.jit.script_method
   def forward(self, kpts, scores):
-    inputs = [kpts.transpose(1, 2), scores.unsqueeze(1)]
-    return self.encoder(torch.cat(inputs, dim=1))
-
-
-def attention(query, key, value):
-  dim = query.shape[1]
-  scores = torch.einsum('bdhn,bdhm->bhnm', query, key) / dim**.5
-  prob = torch.nn.functional.softmax(scores, dim=-1)
-  return torch.einsum('bhnm,bdhm->bdhn', prob, value), prob
+    # Write (x, y, score) straight into one contiguous (b*n, 3) input.
+    b, n, _ = kpts.shape
+    inputs = kpts.new_empty(b, n, 3)
+    inputs[:, :, :2] = kpts
+    inputs[:, :, 2] = scores
+    return self.encoder(inputs.view(b*n, 3)).view(b, n, -1)
 
 
 class MultiHeadedAttention(torch.jit.ScriptModule):
   """ Multi-head attention to increase model expressivitiy """
-  prob: List[torch.Tensor]
 
   def __init__(self, num_heads: int, d_model: int):
     super().__init__()
     assert d_model % num_heads == 0
     self.dim = d_model // num_heads
     self.num_heads = num_heads
-    self.merge = nn.Conv1d(d_model, d_model, kernel_size=1)
+    self.merge = nn.Linear(d_model, d_model)
     self.proj = nn.ModuleList([deepcopy(self.merge) for _ in range(3)])
-    self.prob = []
+
+  @torch.jit.script_method
+  def split_heads(self, x):
+    """ (b, n, d_model) projection to head-major (b, num_heads, n, dim) """
+    return x.view(x.size(0), -1, self.num_heads, self.dim).transpose(1, 2)
 
   @torch.jit.script_method
   def forward(self, query, key, value):
     batch_dim = query.size(0)
-    query, key, value = [l(x).view(batch_dim, self.dim, self.num_heads, -1)
+    query, key, value = [self.split_heads(l(x))
                          for l, x in zip(self.proj, (query, key, value))]
-    x, prob = attention(query, key, value)
-    self.prob.append(prob)
-    return self.merge(x.contiguous().view(batch_dim, self.dim*self.num_heads, -1))
+    x = torch.nn.functional.scaled_dot_product_attention(query, key, value)
+    # SDPA lays its output out in memory as (b, n, num_heads, dim), like the
+    # inputs, so merging the heads back is a view and not a copy.
+    x = x.transpose(1, 2).reshape(batch_dim, -1, self.dim*self.num_heads)
+    return self.merge(x)
+
+  @torch.jit.script_method
+  def attn_weights(self, query, key):
+    """ Recompute the (b, num_heads, n, m) attention probabilities
+
+    forward() never materializes them, so this is the way to inspect them.
+    """
+    query = self.split_heads(self.proj[0](query))
+    key = self.split_heads(self.proj[1](key))
+    # Scaling the (b, h, n, d) query is cheaper than the (b, h, n, m) scores.
+    scores = torch.matmul(query * self.dim**-.5, key.transpose(-2, -1))
+    return torch.nn.functional.softmax(scores, dim=-1)
 
 
 class AttentionalPropagation(torch.jit.ScriptModule):
@@ -126,7 +149,9 @@ class AttentionalPropagation(torch.jit.ScriptModule):
   @torch.jit.script_method
   def forward(self, x, source):
     message = self.attn(x, source, source)
-    return self.mlp(torch.cat([x, message], dim=1))
+    b, n, _ = x.shape
+    y = torch.cat([x, message], dim=-1).view(b*n, -1)
+    return self.mlp(y).view(b, n, -1)
 
 
 class AttentionalGNN(torch.jit.ScriptModule):
@@ -139,8 +164,20 @@ class AttentionalGNN(torch.jit.ScriptModule):
 
   @torch.jit.script_method
   def forward(self, desc0, desc1):
+    if desc0.shape[1] == desc1.shape[1]:
+      # Same number of keypoints: stack both images along the batch dimension
+      # and run each layer once.
+      b = desc0.size(0)
+      desc = torch.cat([desc0, desc1])
+      for i, layer in enumerate(self.layers):
+        if self.names[i] == 'cross':
+          src = torch.cat([desc[b:], desc[:b]])
+        else:  # if name == 'self':
+          src = desc
+        desc = desc + layer(desc, src)
+      return desc[:b], desc[b:]
+
     for i, layer in enumerate(self.layers):
-      layer.attn.prob = []
       if self.names[i] == 'cross':
         src0, src1 = desc1, desc0
       else:  # if name == 'self':
@@ -150,39 +187,106 @@ class AttentionalGNN(torch.jit.ScriptModule):
     return desc0, desc1
 
 
-def log_sinkhorn_iterations(Z, log_mu, log_nu, iters: int):
-  """ Perform Sinkhorn Normalization in Log-space for stability"""
+def logsumexp(x, dim: int):
+  """ Unfused logsumexp (keeping dim) so that the fuser sees the elementwise ops"""
+  m = x.amax(dim, keepdim=True)
+  return m + (x - m).exp().sum(dim, keepdim=True).log()
+
+
+@torch.jit.script
+def log_sinkhorn_iterations(Z, log_mu, log_nu, iters: int, tol: float = 0.):
+  """ Perform Sinkhorn Normalization in Log-space for stability
+
+  Stops before `iters` once the potential u moves by less than `tol`
+  (max-norm). A non-positive `tol` always runs all the iterations.
+  """
+  log_mu, log_nu = log_mu.unsqueeze(2), log_nu.unsqueeze(1)
   u, v = torch.zeros_like(log_mu), torch.zeros_like(log_nu)
   for _ in range(iters):
-    u = log_mu - torch.logsumexp(Z + v.unsqueeze(1), dim=2)
-    v = log_nu - torch.logsumexp(Z + u.unsqueeze(2), dim=1)
-  return Z + u.unsqueeze(2) + v.unsqueeze(1)
+    u_prev = u
+    u = log_mu - logsumexp(Z + v, dim=2)
+    v = log_nu - logsumexp(Z + u, dim=1)
+    if tol > 0. and bool((u - u_prev).abs().max() < tol):
+      break
+  return Z + u + v
 
 
-def log_optimal_transport(scores, alpha, iters: int):
-  """ Perform Differentiable Optimal Transport in Log-space for stability"""
+class LogSinkhorn(torch.jit.ScriptModule):
+  """ Sinkhorn normalization step of the optimal transport layer
+
+  A module so that SuperGlue can swap in another implementation, see
+  models/sinkhorn_kernel.py.
+  """
+
+  def __init__(self, iters: int, tol: float = 0.):
+    super().__init__()
+    self.iters = iters
+    self.tol = tol
+
+  @torch.jit.script_method
+  def forward(self, Z, log_mu, log_nu):
+    return log_sinkhorn_iterations(Z, log_mu, log_nu, self.iters, self.tol)
+
+
+def optimal_transport_problem(scores, alpha):
+  """ Add the dustbins to the scores and build the log-space marginals"""
   b, m, n = scores.shape
-  ms, ns = torch.tensor(m).to(scores), torch.tensor(n).to(scores)
 
-  bins0 = alpha.expand(b, m, 1)
-  bins1 = alpha.expand(b, 1, n)
-  alpha = alpha.expand(b, 1, 1)
+  # Write the scores and the dustbin scores into a single padded buffer.
+  # F.pad(scores, (0, 1, 0, 1), value=alpha.item()) would be no cheaper, and
+  # .item() syncs with the device and cuts the gradient to bin_score.
+  couplings = scores.new_empty((b, m + 1, n + 1))
+  couplings[:, :m, :n] = scores
+  couplings[:, :m, n] = alpha
+  couplings[:, m, :] = alpha
 
-  couplings = torch.cat([torch.cat([scores, bins0], -1),
-                         torch.cat([bins1, alpha], -1)], 1)
+  # The marginals only depend on m and n: compute them on the host as Python
+  # floats instead of building and copying scalar tensors to the device.
+  norm = - math.log(m + n)
+  log_mu = scores.new_full((b, m + 1), norm)
+  log_mu[:, m] = math.log(n) + norm
+  log_nu = scores.new_full((b, n + 1), norm)
+  log_nu[:, n] = math.log(m) + norm
+  return couplings, log_mu, log_nu, norm
 
-  norm = - (ms + ns).log()
-  log_mu = torch.cat([norm.expand(m), ns.log()[None] + norm])
-  log_nu = torch.cat([norm.expand(n), ms.log()[None] + norm])
-  log_mu, log_nu = log_mu[None].expand(b, -1), log_nu[None].expand(b, -1)
 
+def log_optimal_transport(scores, alpha, iters: int):
+  """ Perform Differentiable Optimal Transport in Log-space for stability"""
+  couplings, log_mu, log_nu, norm = optimal_transport_problem(scores, alpha)
   Z = log_sinkhorn_iterations(couplings, log_mu, log_nu, iters)
   Z = Z - norm  # multiply probabilities by M+N
   return Z
 
 
+def conv1d_to_linear(state_dict: Dict[str, torch.Tensor], num_heads: int = 4):
+  """ Convert the released pointwise Conv1d weights to the Linear layers
+
+  Conv1d weights (out, in, 1) are squeezed to (out, in). The attention
+  projections of these checkpoints interleave their channels as
+  (dim, num_heads); they are reordered to the (num_heads, dim) layout of
+  MultiHeadedAttention. State dicts already in the Linear layout are
+  returned unchanged.
+  """
+  def head_major(channels: int):
+    perm = torch.arange(channels)
+    return perm.view(channels // num_heads, num_heads).t().reshape(-1)
+
+  converted = OrderedDict()
+  for k, v in state_dict.items():
+    module = k.rpartition('.')[0]
+    weight = state_dict.get(module + '.weight', v)
+    if weight.dim() == 3:
+      v = v.squeeze(-1) if v.dim() == 3 else v
+      if '.attn.proj.' in k:  # output channels
+        v = v[head_major(v.shape[0])]
+      elif k.endswith('.attn.merge.weight'):  # input channels
+        v = v[:, head_major(v.shape[1])]
+    converted[k] = v
+  return converted
+
+
 def arange_like(x, dim: int):
-  return torch.ones(x.shape[dim], dtype=x.dtype, device=x.device).cumsum(0) - 1
+  return torch.arange(x.shape[dim], dtype=x.dtype, device=x.device)
 
 
 class SuperGlue(torch.jit.ScriptModule):
@@ -209,18 +313,34 @@ class SuperGlue(torch.jit.ScriptModule):
       'keypoint_encoder': [32, 64, 128, 256],
       'GNN_layers': ['self', 'cross'] * 9,
       'sinkhorn_iterations': 50,
+      # Early exit once the Sinkhorn potential u changes by less than this.
+      # Off by default: the check costs a host sync per iteration.
+      'sinkhorn_tolerance': 0.,
+      'sinkhorn_kernel': 'torch',  # or 'triton' (CUDA only, inference only)
       'match_threshold': 0.2,
+      'preset': None,
+  }
+  # Opt-in overrides of default_config, selected with config['preset'].
+  # Explicit config entries still take precedence.
+  presets = {
+      # Fewer Sinkhorn iterations: the ScanNet sample matches are unchanged,
+      # but matching scores move and those near match_threshold can flip.
+      'indoor_fast': {'weights': 'indoor', 'sinkhorn_iterations': 20},
   }
 
   def __init__(self, config):
     super().__init__()
-    self.config = {**self.default_config, **config}
+    preset = config.get('preset', None)
+    assert preset is None or preset in self.presets
+    self.config = {**self.default_config,
+                   **(self.presets[preset] if preset else {}), **config}
 
     self.descriptor_dim = self.config['descriptor_dim']
     self.weights = self.config['weights']
     self.keypoint_encoder = self.config['keypoint_encoder']
     self.GNN_layers = self.config['GNN_layers']
     self.sinkhorn_iterations = self.config['sinkhorn_iterations']
+    self.sinkhorn_tolerance = float(self.config['sinkhorn_tolerance'])
     self.match_threshold = self.config['match_threshold']
 
     self.kenc = KeypointEncoder(
@@ -229,9 +349,27 @@ class SuperGlue(torch.jit.ScriptModule):
     self.gnn = AttentionalGNN(
         self.descriptor_dim, self.GNN_layers)
 
-    self.final_proj = nn.Conv1d(
-        self.descriptor_dim, self.descriptor_dim,
-        kernel_size=1, bias=True)
+    self.final_proj = nn.Linear(
+        self.descriptor_dim, self.descriptor_dim, bias=True)
+
+    assert self.config['sinkhorn_kernel'] in ['torch', 'triton']
+    if self.config['sinkhorn_kernel'] == 'triton':
+      # The fused kernels do not stop early. Not the default: a model
+      # scripted with the custom op does not load outside of Python.
+      assert self.sinkhorn_tolerance <= 0, 'sinkhorn_tolerance must be 0'
+      if not hasattr(torch.library, 'custom_op'):
+        raise RuntimeError(
+            "'sinkhorn_kernel': 'triton' requires torch>=2.4, found {}".format(
+                torch.__version__))
+      try:
+        from .sinkhorn_kernel import TritonLogSinkhorn
+      except ImportError as e:
+        raise ImportError("'sinkhorn_kernel': 'triton' requires the optional "
+                          "triton package (pip install triton)") from e
+      self.sinkhorn = TritonLogSinkhorn(self.sinkhorn_iterations)
+    else:
+      self.sinkhorn = LogSinkhorn(
+          self.sinkhorn_iterations, self.sinkhorn_tolerance)
 
     bin_score = torch.nn.Parameter(torch.tensor(1.))
     self.register_parameter('bin_score', bin_score)
@@ -239,55 +377,142 @@ class SuperGlue(torch.jit.ScriptModule):
     assert self.weights in ['indoor', 'outdoor']
     path = Path(__file__).parent
     path = path / 'weights/superglue_{}.pth'.format(self.weights)
-    self.load_state_dict(torch.load(path))
+    # The released weights were trained with pointwise Conv1d layers.
+    self.load_state_dict(conv1d_to_linear(torch.load(path)))
     print('Loaded SuperGlue model (\"{}\" weights)'.format(
         self.weights))
 
   @torch.jit.script_method
   def forward(self, kpts0, kpts1, desc0, desc1, scores0, scores1, shape0, shape1):
-    """Run SuperGlue on a pair of keypoints and descriptors"""
-    desc0 = desc0.permute(0, 2, 1)
-    desc1 = desc1.permute(0, 2, 1)
+    """Run SuperGlue on a pair of keypoints and descriptors
+
+    All per-keypoint tensors stay channel-last (b, n, c) throughout.
+    """
+    center0, scaling0 = keypoint_transform(shape0.to(kpts0.device))
+    center1, scaling1 = keypoint_transform(shape1.to(kpts1.device))
+    return self.match(kpts0, kpts1, desc0, desc1, scores0, scores1,
+                      center0, scaling0, center1, scaling1)
 
+  @torch.jit.script_method
+  def match(self, kpts0, kpts1, desc0, desc1, scores0, scores1,
+            center0, scaling0, center1, scaling1):
+    """Same as forward, with the keypoint_transform of each image size"""
     if kpts0.shape[1] == 0 or kpts1.shape[1] == 0:  # no keypoints
       kshape0, kshape1 = kpts0.shape[:-1], kpts1.shape[:-1]
-      return kpts0.new_full(kshape0, -1, dtype=torch.int), kpts0.new_zeros(shape0)
+      return kpts0.new_full(kshape0, -1, dtype=torch.int), kpts0.new_zeros(kshape0)
 
+    # Run the network in the precision of the weights, e.g. after
+    # model.half() or model.bfloat16(); inputs are usually float32.
+    dtype = self.final_proj.weight.dtype
+    desc0, desc1 = desc0.to(dtype), desc1.to(dtype)
+    scores0, scores1 = scores0.to(dtype), scores1.to(dtype)
 
     # Keypoint normalization.
-    kpts0 = normalize_keypoints(kpts0, shape0) # shape: 1,W,H
-    kpts1 = normalize_keypoints(kpts1, shape1) # shape: 1,W,H
+    kpts0 = ((kpts0 - center0) / scaling0).to(dtype)
+    kpts1 = ((kpts1 - center1) / scaling1).to(dtype)
 
-    # Keypoint MLP encoder.
-    desc0 = desc0 + self.kenc(kpts0, scores0)
-    desc1 = desc1 + self.kenc(kpts1, scores1)
+    # Keypoint MLP encoder, run once over the keypoints of both images.
+    n0, n1 = kpts0.shape[1], kpts1.shape[1]
+    kenc0, kenc1 = self.kenc(
+        torch.cat([kpts0, kpts1], dim=1),
+        torch.cat([scores0, scores1], dim=1)).split([n0, n1], dim=1)
+    desc0 = desc0 + kenc0
+    desc1 = desc1 + kenc1
 
     # Multi-layer Transformer network.
     desc0, desc1 = self.gnn(desc0, desc1)
 
-    # Final MLP projection.
-    mdesc0, mdesc1 = self.final_proj(desc0), self.final_proj(desc1)
+    # Final MLP projection, as a single GEMM over both descriptor sets.
+    mdesc = self.final_proj(torch.cat([desc0, desc1], dim=1))
+    mdesc0, mdesc1 = mdesc.split([n0, n1], dim=1)
 
-    # Compute matching descriptor distance.
-    scores = torch.einsum('bdn,bdm->bnm', mdesc0, mdesc1)
-    scores = scores / self.descriptor_dim**.5
+    # Compute matching descriptor distance. Scaling the (b, n, d) operand
+    # by 1/sqrt(D) is cheaper than scaling the (b, n, m) scores.
+    scores = torch.bmm(
+        mdesc0 * self.descriptor_dim**-.5, mdesc1.transpose(1, 2))
 
-    # Run the optimal transport.
-    scores = log_optimal_transport(
-        scores, self.bin_score,
-        iters=self.sinkhorn_iterations)
+    # Run the optimal transport, always in float32 for a stable logsumexp.
+    couplings, log_mu, log_nu, norm = optimal_transport_problem(
+        scores.float(), self.bin_score.float())
+    scores = self.sinkhorn(couplings, log_mu, log_nu)
+    scores = scores - norm  # multiply probabilities by M+N
 
     # Get the matches with score above "match_threshold".
-    max0, max1 = scores[:, :-1, :-1].max(2), scores[:, :-1, :-1].max(1)
-    indices0, indices1 = max0.indices, max1.indices
+    # Only the values of the row-wise maximum are used, so the column-wise
+    # reduction is a plain argmax.
+    scores = scores[:, :-1, :-1]
+    max0, indices0 = scores.max(2)
+    indices1 = scores.argmax(1)
     mutual0 = arange_like(indices0, 1)[None] == indices1.gather(1, indices0)
     # mutual1 = arange_like(indices1, 1)[None] == indices0.gather(1, indices1)
-    zero = torch.tensor(0).to(scores)
-    mscores0 = torch.where(mutual0, max0.values.exp(), zero)
-    # mscores1 = torch.where(mutual1, mscores0.gather(1, indices1), zero)
+    mscores0 = max0.exp().masked_fill(~mutual0, 0.)
+    # mscores1 = mscores0.gather(1, indices1).masked_fill(~mutual1, 0.)
     valid0 = mutual0 & (mscores0 > self.match_threshold)
     # valid1 = mutual1 & valid0.gather(1, indices1)
-    indices0 = torch.where(valid0, indices0, torch.tensor(-1).to(indices0))
-    # indices1 = torch.where(valid1, indices1, torch.tensor(-1).to(indices1))
+    indices0 = indices0.masked_fill(~valid0, -1)
+    # indices1 = indices1.masked_fill(~valid1, -1)
     indices0 = indices0.float() # !for serving.
     return indices0,mscores0
+
+
+class CUDAGraphSuperGlue:
+  """ Replay a SuperGlue forward as a single CUDA graph
+
+  For deployments with a fixed number of keypoints (e.g. a fixed
+  'max_keypoints' in SuperPoint), the whole forward, including every Sinkhorn
+  iteration, is captured once from example inputs and then replayed, removing
+  the per-op launch and dispatch overhead.
+
+  Calls must use the same keypoint counts as the capture. The graph runs
+  SuperGlue.match on the keypoint_transform of the image sizes, kept in
+  static device buffers that are only recomputed when a call passes new
+  sizes. The graph runs on a private copy of the model in eval mode, so later
+  changes to `model` are not seen. The returned tensors are static buffers
+  overwritten by the next call.
+  """
+
+  def __init__(self, model: SuperGlue, kpts0, kpts1, desc0, desc1,
+               scores0, scores1, shape0, shape1, warmup: int = 3):
+    # Early stopping reads the residual on the host, which cannot be captured.
+    assert model.sinkhorn_tolerance <= 0, 'sinkhorn_tolerance must be 0'
+    # BatchNorm would update its running stats on every replay.
+    assert not model.training, 'call model.eval() before capturing'
+    # The graph holds raw pointers to the parameters and to every tensor it
+    # reads: keep its own copy of them alive for the lifetime of the graph.
+    self.model = deepcopy(model)
+    device = kpts0.device
+    self.static_inputs = [
+        x.clone() for x in (kpts0, kpts1, desc0, desc1, scores0, scores1)]
+    # Kept on the device so that no host-to-device copy is captured.
+    for shape in (shape0, shape1):
+      self.static_inputs += keypoint_transform(shape.to(device))
+
+    # Warm up on a side stream so that TorchScript finishes profiling and
+    # optimizing the graph before the capture.
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.no_grad(), torch.cuda.stream(stream):
+      for _ in range(warmup):
+        self.model.match(*self.static_inputs)
+    torch.cuda.current_stream().wait_stream(stream)
+
+    self.graph = torch.cuda.CUDAGraph()
+    with torch.no_grad(), torch.cuda.graph(self.graph):
+      self.static_outputs = self.model.match(*self.static_inputs)
+
+  def __call__(self, kpts0, kpts1, desc0, desc1, scores0, scores1,
+               shape0=None, shape1=None):
+    """ Image sizes default to the last ones given """
+    inputs = (kpts0, kpts1, desc0, desc1, scores0, scores1)
+    for static, x in zip(self.static_inputs, inputs):
+      if x.shape != static.shape:
+        raise ValueError('Input shape {} differs from the captured {}'.format(
+            tuple(x.shape), tuple(static.shape)))
+      static.copy_(x)
+    for i, shape in zip((6, 8), (shape0, shape1)):
+      if shape is not None:
+        center, scaling = keypoint_transform(shape.to(kpts0.device))
+        self.static_inputs[i].copy_(center)
+        self.static_inputs[i + 1].copy_(scaling)
+    self.graph.replay()
+    return self.static_outputs